@@ -5,28 +5,535 @@ Core encryption/decryption functionality.
 See http://eli.thegreenplace.net/2010/06/25/
 aes-encryption-of-files-in-python-with-pycrypto.
 
+AES is provided by the `cryptography` package, which delegates to OpenSSL's
+EVP interface. OpenSSL selects hand-tuned AES-GCM code for the running CPU:
+AES-NI and PCLMULQDQ on x86, the Crypto Extensions on ARMv8. Where
+`cryptography` is not installed, pycryptodome (the `pycryptodome` extra) is
+used instead; the output is the same.
+
+Files are encrypted with AES in GCM mode. The encrypted file layout, format
+version 2, is:
+
+    <7 byte marker '\\x89CRYPTK'><1 byte format version, 2>
+    <8 byte little-endian plaintext length><16 byte nonce>
+    <ciphertext, same length as the plaintext><16 byte GCM tag>
+
+Version 1 files, written by cryptkeeper 1.x, have no marker:
+
+    <8 byte little-endian plaintext length><16 byte IV>
+    <AES-CBC ciphertext of the plaintext, random padding to a whole block,
+     8 random bytes and the 8 byte plaintext length>
+
+They are still decrypted, but are not authenticated.
+
 """
 
 
+import errno
+import mmap
 import os
+import queue
 import struct
+import threading
+import traceback
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers import algorithms
+    from cryptography.hazmat.primitives.ciphers import Cipher
+    from cryptography.hazmat.primitives.ciphers import modes
+except ImportError:
+    Cipher = None
 
-from Crypto.Cipher import AES
-from Crypto import Random
+try:
+    # pycryptodome 3.7 or later, for the output argument of encrypt().
+    from Crypto.Cipher import AES
+except ImportError:
+    AES = None
 
+from cryptkeeper import errors
 
+
+_AES_BLOCK_SIZE = 16
 _IV_SIZE = 16
-_FILE_LENGTH_FIELD_SIZE = struct.calcsize('Q')
-_CHUNK_MIN_SIZE = 1024
-DEFAULT_ENCRYPT_CHUNKSIZE = 64 * _CHUNK_MIN_SIZE
-DEFAULT_DECRYPT_CHUNKSIZE = 24 * _CHUNK_MIN_SIZE
+_TAG_SIZE = 16
+# Some cryptography versions insist on this much room beyond the input
+# length in update_into() output buffers.
+_UPDATE_INTO_SLACK = _AES_BLOCK_SIZE - 1
+
+# The AES implementation in use. Tests may switch it to 'pycryptodome' where
+# both are installed.
+if Cipher is not None:
+    _BACKEND = 'cryptography'
+elif AES is not None:
+    _BACKEND = 'pycryptodome'
+else:
+    raise ImportError(
+        'cryptkeeper needs either the cryptography or pycryptodome package.'
+        )
+
+# What a failed tag check raises, depending on the backend.
+_AUTHENTICATION_ERRORS = (
+    (InvalidTag, ValueError) if Cipher is not None else (ValueError,)
+    )
+# The format is compiled once, rather than on every pack/unpack call.
+_FILE_LENGTH_FIELD = struct.Struct('<Q')
+_FILE_LENGTH_FIELD_SIZE = _FILE_LENGTH_FIELD.size
+
+# Version 2 and later files start with a marker and the format version. A
+# version 1 file starts with its plaintext length instead, and read as a
+# little-endian length, the marker and any non-zero version would be over
+# 2**56 bytes, so the two cannot be confused.
+_FORMAT_MARKER = b'\x89CRYPTK'
+_FORMAT_VERSION = 2
+_PREAMBLE = struct.Struct('<7sB')
+_HEADER = struct.Struct('<7sBQ{}s'.format(_IV_SIZE))
+_HEADER_SIZE = _HEADER.size
+_LENGTH_OFFSET = _PREAMBLE.size  # Of the plaintext length in the header.
+_CHUNK_ALIGNMENT = 4096  # A page, and a multiple of the AES block size.
+
+# 1 MiB chunks amortize the per-read()/write() syscall cost and leave the
+# kernel's readahead room to work; throughput gains flatten out somewhere
+# between 256 KiB and 1 MiB. Larger chunks only cost memory: each operation
+# holds 2 * _PIPELINE_BUFFERS chunks.
+DEFAULT_ENCRYPT_CHUNKSIZE = 1024 * 1024
+DEFAULT_DECRYPT_CHUNKSIZE = 1024 * 1024
+
+# encrypt_file maps files larger than this into memory instead of reading and
+# writing them, saving a copy of every byte to and from the page cache.
+_MMAP_THRESHOLD = 16 * 1024 * 1024
+
+# Number of chunk buffers on each side of the cipher in _transform_stream.
+_PIPELINE_BUFFERS = 4
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+class _PycryptodomeContext(object):
+    """A pycryptodome GCM cipher behind the cryptography context interface.
+
+    Only the parts of the encryptor and decryptor interfaces this module
+    uses are provided.
+    """
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def __init__(self, key, iv, decrypt):
+        cipher = AES.new(key, AES.MODE_GCM, nonce=iv)
+        self._cipher = cipher
+        self._transform = cipher.decrypt if decrypt else cipher.encrypt
+        self.tag = None
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def update(self, data):
+        """Return the transformation of data."""
+        return self._transform(data)
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def update_into(self, data, buf):
+        """Write the transformation of data into buf; return its length."""
+        length = len(data)
+        self._transform(data, output=buf[:length])
+        return length
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def finalize(self):
+        """Compute the tag of everything encrypted."""
+        self.tag = self._cipher.digest()
+        return b''
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def finalize_with_tag(self, tag):
+        """Raise ValueError if tag does not authenticate the ciphertext."""
+        self._cipher.verify(tag)
+        return b''
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def _new_cipher_context(key, iv, decrypt=False):
+    """Return an AES-GCM encryptor, or decryptor, for key and iv.
+
+    The context has the cryptography package's interface whichever backend
+    is in use.
+    """
+    if _BACKEND == 'pycryptodome':
+        return _PycryptodomeContext(key, iv, decrypt)
+
+    cipher = Cipher(algorithms.AES(key), modes.GCM(iv))
+    return cipher.decryptor() if decrypt else cipher.encryptor()
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def _new_legacy_decryptor(key, iv):
+    """Return a function decrypting version 1 (AES-CBC) ciphertext.
+
+    It must be given whole blocks, in order.
+    """
+    if _BACKEND == 'pycryptodome':
+        return AES.new(key, AES.MODE_CBC, iv).decrypt
+
+    return Cipher(algorithms.AES(key), modes.CBC(iv)).decryptor().update
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def _header(length, iv):
+    """Return the file header for a length byte plaintext and iv.
+
+    The header is packed in place into one preallocated buffer.
+    """
+    header = bytearray(_HEADER_SIZE)
+    _HEADER.pack_into(header, 0, _FORMAT_MARKER, _FORMAT_VERSION, length, iv)
+    return header
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def _check_chunksize(chunksize):
+    """Raise ValueError if chunksize is not a positive multiple of 4 KiB."""
+    if chunksize <= 0 or chunksize % _CHUNK_ALIGNMENT != 0:
+        raise ValueError(
+            'chunksize must be a positive multiple of {}, not {}.'.format(
+                _CHUNK_ALIGNMENT, chunksize
+                )
+            )
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def _advise_sequential(fptr):
+    """Tell the kernel fptr will be read sequentially, where supported.
+
+    This lets the kernel use a larger readahead window. It is only a hint,
+    so platforms without posix_fadvise() and files that reject it (pipes,
+    for example) are silently left alone.
+    """
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fptr.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def _preallocate(fptr, size):
+    """Reserve disk space for the first size bytes of fptr, if possible.
+
+    Returns False where space cannot be reserved up front: on platforms
+    without posix_fallocate() and on filesystems that do not support it.
+    Writes through a memory map are only safe once the space is reserved,
+    as running out of space would otherwise crash the process with SIGBUS
+    rather than raise an exception.
+    """
+    if not hasattr(os, 'posix_fallocate'):
+        return False
+
+    try:
+        os.posix_fallocate(fptr.fileno(), 0, size)
+    except OSError as exc:
+        if exc.errno in (errno.EINVAL, errno.EOPNOTSUPP):
+            return False
+        raise
+
+    return True
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def _encrypt_mapped(encryptor, header, in_fptr, out_fptr, size, chunksize):
+    """Encrypt size bytes of in_fptr into out_fptr through memory maps.
+
+    out_fptr must be open for reading and writing and already sized by
+    _preallocate() for header, the ciphertext and the tag. Each chunk is
+    encrypted straight from the input mapping into the output mapping, so
+    the data is never copied through Python buffers or read()/write().
+    """
+
+    start = len(header)
+    total = start + size + _TAG_SIZE
+    update_into = encryptor.update_into
+
+    with mmap.mmap(
+            in_fptr.fileno(), size, access=mmap.ACCESS_READ
+            ) as in_map, mmap.mmap(out_fptr.fileno(), total) as out_map:
+        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+            in_map.madvise(mmap.MADV_SEQUENTIAL)
+            out_map.madvise(mmap.MADV_SEQUENTIAL)
+
+        with memoryview(in_map) as source, memoryview(out_map) as target:
+            try:
+                target[:start] = header
+                # The output slices run to the end of the mapping, which
+                # leaves update_into() its _UPDATE_INTO_SLACK in the tag's
+                # space.
+                for offset in range(0, size, chunksize):
+                    update_into(
+                        source[offset:offset + chunksize],
+                        target[start + offset:]
+                        )
+                target[start + size:] = encryptor.finalize() + encryptor.tag
+            except BaseException as exc:
+                _drop_slices(exc)
+                raise
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def _drop_slices(exc):
+    """Clear the frames exc was raised through, before a mapping closes.
+
+    Mapping slices held by the frames' locals would otherwise make closing
+    the mapping raise BufferError in place of exc.
+    """
+    traceback.clear_frames(exc.__traceback__)
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def _read_exactly(fptr, size):
+    """Read size bytes from fptr, which may be unbuffered.
+
+    Fewer bytes are returned only at EOF.
+    """
+    data = fptr.read(size)
+    while data is not None and len(data) < size:
+        more = fptr.read(size - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def _read_field(fptr, size, name):
+    """Read the size byte header or trailer field name from fptr.
+
+    Raises errors.DecryptionError if fptr ends first.
+    """
+    data = _read_exactly(fptr, size)
+    if data is None or len(data) < size:
+        raise errors.DecryptionError(
+            'Encrypted data is truncated in its {}.'.format(name)
+            )
+    return data
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def _write_all(fptr, data):
+    """Write all of data to fptr, which may be unbuffered."""
+    with memoryview(data) as view:
+        written = 0
+        while written < len(view):
+            written += fptr.write(view[written:])
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def _transform_stream(
+        in_fptr, out_fptr, transform, chunksize, size=None, mapping=None
+        ):
+    """Pass in_fptr through transform into out_fptr, a chunk at a time.
+
+    transform(source, destination) is called with memoryviews, and must
+    write its result into destination and return its length, like a
+    cipher context's update_into(); destination has room for
+    len(source) + _UPDATE_INTO_SLACK bytes. It is called on the chunks in
+    order, in the calling thread.
+
+    in_fptr and out_fptr may be unbuffered (raw) file objects: the chunk
+    buffers take the place of io's buffering, and short reads and partial
+    writes are handled.
+
+    Reading in_fptr and writing out_fptr are done in their own threads, so
+    disk I/O overlaps with the cipher instead of alternating with it. The
+    chunk buffers are preallocated and recycled through pools, which also
+    bound how far the reader can get ahead of the writer.
+
+    If size is not None, at most size bytes are read from in_fptr, otherwise
+    it is read to EOF. Returns the number of bytes transformed.
+
+    If mapping is not None it must be a memoryview of the whole input, for
+    example of an mmap, and in_fptr and size are ignored. The chunks are
+    then slices of mapping, passed to transform without being read into a
+    buffer first, and no reader thread is needed. transform must not keep
+    references to its source, or the mapping cannot be released.
+    """
+
+    free_in_buffers = queue.Queue()
+    free_out_buffers = queue.Queue()
+    for _ in range(_PIPELINE_BUFFERS):
+        if mapping is None:
+            free_in_buffers.put(memoryview(bytearray(chunksize)))
+        free_out_buffers.put(
+            memoryview(bytearray(chunksize + _UPDATE_INTO_SLACK))
+            )
+
+    read_chunks = queue.Queue()
+    write_chunks = queue.Queue()
+    write_errors = []
+
+    # - - - - - - - - - - - - - - - - - - - - - - - -
+    def reader():
+        """Fill free buffers from in_fptr until EOF, size or stopped.
+
+        A None buffer from the pool is the signal to stop early.
+        """
+        # Bound methods are looked up once, not once per chunk.
+        get_buffer = free_in_buffers.get
+        readinto = in_fptr.readinto
+        put_chunk = read_chunks.put
+
+        remaining = size
+        try:
+            while remaining is None or remaining > 0:
+                buffer = get_buffer()
+                if buffer is None:
+                    break
+                if remaining is not None and remaining < chunksize:
+                    length = readinto(buffer[:remaining])
+                else:
+                    length = readinto(buffer)
+                if not length:
+                    break
+                if remaining is not None:
+                    remaining -= length
+                put_chunk((buffer, length))
+        except BaseException as exc:  # pylint: disable=broad-except
+            read_chunks.put((exc, 0))
+        else:
+            read_chunks.put((None, 0))
+
+    # - - - - - - - - - - - - - - - - - - - - - - - -
+    def read_chunk_iterator():
+        """Yield the (buffer, length) pairs filled by reader()."""
+        get_chunk = read_chunks.get
+        while True:
+            buffer, length = get_chunk()
+            if buffer is None:
+                return
+            if isinstance(buffer, BaseException):
+                raise buffer
+            yield buffer, length
+
+    # - - - - - - - - - - - - - - - - - - - - - - - -
+    def mapped_chunk_iterator():
+        """Yield (slice, length) pairs covering mapping."""
+        for offset in range(0, len(mapping), chunksize):
+            chunk = mapping[offset:offset + chunksize]
+            yield chunk, len(chunk)
+
+    # - - - - - - - - - - - - - - - - - - - - - - - -
+    def writer():
+        """Write filled buffers to out_fptr until given a None buffer.
+
+        out_fptr may be unbuffered, so partial writes are retried. After an
+        error, buffers are still consumed so nothing blocks.
+        """
+        get_chunk = write_chunks.get
+        write = out_fptr.write
+        put_buffer = free_out_buffers.put
+
+        while True:
+            buffer, length = get_chunk()
+            if buffer is None:
+                break
+            if not write_errors:
+                try:
+                    written = 0
+                    while written < length:
+                        written += write(buffer[written:length])
+                except BaseException as exc:  # pylint: disable=broad-except
+                    write_errors.append(exc)
+            put_buffer(buffer)
+
+    # - - - - - - - - - - - - - - - - - - - - - - - -
+    if mapping is None:
+        reader_thread = threading.Thread(target=reader)
+        reader_thread.start()
+        chunks = read_chunk_iterator()
+    else:
+        reader_thread = None
+        chunks = mapped_chunk_iterator()
+
+    writer_thread = threading.Thread(target=writer)
+    writer_thread.start()
+
+    get_buffer = free_out_buffers.get
+    put_buffer = free_in_buffers.put
+    put_chunk = write_chunks.put
+
+    in_buffer = None
+    transformed = 0
+    try:
+        for in_buffer, length in chunks:
+            if write_errors:
+                break
+
+            out_buffer = get_buffer()
+            out_length = transform(in_buffer[:length], out_buffer)
+            if mapping is None:
+                put_buffer(in_buffer)
+            put_chunk((out_buffer, out_length))
+            transformed += length
+    finally:
+        # Drop any reference into mapping now, even if an exception is
+        # propagating, so the caller can close the underlying mmap.
+        in_buffer = chunks = None
+
+        free_in_buffers.put(None)
+        write_chunks.put((None, 0))
+        if reader_thread is not None:
+            reader_thread.join()
+        writer_thread.join()
+
+    if write_errors:
+        raise write_errors[0]
+
+    return transformed
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def _encrypt_to(encryptor, header, in_fptr, out_fptr, filesize, chunksize):
+    """Write header and the encryption of in_fptr to out_fptr.
+
+    This implements encrypt_file, once the files are open.
+    """
+
+    # GCM is a stream mode, so unlike the original CBC algorithm no padding
+    # or trailing length record is needed: the ciphertext is exactly as long
+    # as the plaintext, and the GCM tag authenticates it.
+    if filesize > _MMAP_THRESHOLD and _preallocate(
+            out_fptr, len(header) + filesize + _TAG_SIZE
+            ):
+        _encrypt_mapped(
+            encryptor, header, in_fptr, out_fptr, filesize, chunksize
+            )
+        return
+
+    _write_all(out_fptr, header)
+
+    if filesize > _MMAP_THRESHOLD:
+        with mmap.mmap(
+                in_fptr.fileno(), 0, access=mmap.ACCESS_READ
+                ) as in_map:
+            if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                in_map.madvise(mmap.MADV_SEQUENTIAL)
+            with memoryview(in_map) as mapping:
+                try:
+                    _transform_stream(
+                        None,
+                        out_fptr,
+                        encryptor.update_into,
+                        chunksize,
+                        mapping=mapping
+                        )
+                except BaseException as exc:
+                    _drop_slices(exc)
+                    raise
+    else:
+        _transform_stream(
+            in_fptr, out_fptr, encryptor.update_into, chunksize
+            )
+
+    _write_all(out_fptr, encryptor.finalize() + encryptor.tag)
 
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 def encrypt_file(
         key, in_filename, out_filename=None, chunksize=DEFAULT_ENCRYPT_CHUNKSIZE
         ):
-    """ Encrypts a file using AES (CBC mode) with the given key.
+    """ Encrypts a file using AES (GCM mode) with the given key.
 
         key:
             The encryption key - a string that must be either 16, 24 or 32 bytes
@@ -43,70 +550,39 @@ def encrypt_file(
     #     chunksize:
     #         Sets the size of the chunk which the function uses to read and
     #         encrypt the file. Larger chunk sizes can be faster for some files
-    #         and machines. chunksize must be divisible by 16.
+    #         and machines. chunksize must be a multiple of 4096.
     #
     # """
-    # TODO: Add a MAC in the padding?
+
+    _check_chunksize(chunksize)
 
     if not out_filename:
         out_filename = in_filename + '.enc'
 
-    randomness = Random.new()
-
     # iv = ''.join(chr(random.randint(0, 0xFF)) for i in range(_IV_SIZE))
-    iv = randomness.read(16)
-    encryptor = AES.new(key, AES.MODE_CBC, iv)
+    iv = os.urandom(_IV_SIZE)
+    encryptor = _new_cipher_context(key, iv)
 
     filesize = os.path.getsize(in_filename)
- 
-    with open(in_filename, 'rb') as in_fptr:
-        with open(out_filename, 'wb') as out_fptr:
-            out_fptr.write(struct.pack('<Q', filesize))
-            out_fptr.write(iv)
-
-            final_block = False
-
-            while True:
-                chunk = in_fptr.read(chunksize)
-
-                # if len(chunk) == 0:
-                #     break
-                # elif len(chunk) % 16 != 0:
-                #     chunk += ' ' * (16 - len(chunk) % 16)
-
-                # The original algorithm padded with a space character, but this
-                # is not secure and also can corrupt data that happens to end in
-                # spaces which are significant. We pad to a multiple of 16
-                # with random bytes, then add a 16 byte block consisting of 8
-                # random bytes and an 8 byte field containing the original file
-                # length.
-
-                chunk_length = len(chunk)
-                filesize_record = struct.pack('<Q', filesize)
-                filesize_record_length = len(filesize_record)
-
-                if chunk_length == 0 or (chunk_length % 16) != 0:
-                    final_block = True
-                    chunk += randomness.read(16 - chunk_length % 16)
-
-                    # # padding_length includes the final 8 byte field!
-                    # padding_length = chunksize - chunk_length
-                    # if padding_length < filesize_record_length:
-                    #     # We pad this chunk with randomness and emit it, then
-                    #     # set up to create a full padding chunk.
-                    #     chunk += randomness.read(padding_length)
-                    #     out_fptr.write(encryptor.encrypt(chunk))
-                    #
-                    #     chunk = ''
-                    #     padding_length = chunksize
-                    chunk += randomness.read(16 - filesize_record_length)
-                    chunk += filesize_record
-                    # print('Adding interim chunk size {}'.format(len(chunk)))
-
-                enc = encryptor.encrypt(chunk)
-                out_fptr.write(enc)
-                if final_block:
-                    break
+
+    header = _header(filesize, iv)
+
+    # The files are opened unbuffered: _transform_stream does its own
+    # chunking, so a buffered layer would only add a copy, and the header and
+    # trailer are each written with a single call. The output is opened for
+    # reading too, as mapping it requires.
+    with open(in_filename, 'rb', buffering=0) as in_fptr:
+        _advise_sequential(in_fptr)
+        with open(out_filename, 'w+b', buffering=0) as out_fptr:
+            try:
+                _encrypt_to(
+                    encryptor, header, in_fptr, out_fptr, filesize, chunksize
+                    )
+            except BaseException:
+                # Don't leave a partial, unauthenticated file behind.
+                out_fptr.close()
+                os.remove(out_filename)
+                raise
 
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
@@ -116,31 +592,199 @@ def decrypt_file(
         out_filename=None,
         chunksize=DEFAULT_DECRYPT_CHUNKSIZE
         ):
-    """ Decrypts a file using AES (CBC mode) with the given key.
+    """ Decrypts a file using AES (GCM mode) with the given key.
 
     Parameters are similar to encrypt_file, with one difference: out_filename,
     if not supplied will be in_filename without its last extension (i.e. if
     in_filename is 'aaa.zip.enc' then out_filename will be 'aaa.zip')
+
+    Raises errors.DecryptionError, and removes out_filename, if the
+    ciphertext does not authenticate against the key or in_filename is
+    truncated. Raises
+    errors.UnsupportedFormatError, and removes out_filename, if in_filename
+    was written in a format version this version does not know.
     """
 
+    _check_chunksize(chunksize)
+
     if not out_filename:
         # TODO: This assumes we have a .enc suffix.
         out_filename = os.path.splitext(in_filename)[0]
 
-    with open(in_filename, 'rb') as in_fptr:
+    try:
+        with open(in_filename, 'rb', buffering=0) as in_fptr:
+            _advise_sequential(in_fptr)
+            with open(out_filename, 'wb', buffering=0) as out_fptr:
+                decrypt_stream(key, in_fptr, out_fptr, chunksize=chunksize)
+    except errors.UnsupportedFormatError:
+        os.remove(out_filename)
+        raise
+    except errors.DecryptionError as exc:
+        os.remove(out_filename)
+        msg = 'Decryption of {} failed: {}'.format(in_filename, exc)
+        raise errors.DecryptionError(msg)
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def decrypt_stream(
+        key,
+        in_fptr,
+        out_fptr,
+        chunksize=DEFAULT_DECRYPT_CHUNKSIZE
+        ):
+    """ Decrypts the file object in_fptr into the file object out_fptr.
+
+    in_fptr must be positioned at the start of data written by encrypt_file
+    or EncryptingWriter; it is only read forward. Raises
+    errors.DecryptionError if the ciphertext does not authenticate against
+    the key or the data is truncated, in which case the plaintext already
+    written to out_fptr must be discarded. Raises
+    errors.UnsupportedFormatError if the data has an unknown format version.
+
+    Version 1 data, from cryptkeeper 1.x, is read to the end of in_fptr.
+    It is not authenticated: only a wrong key or a damaged end of the data
+    are detected, by the plaintext length it ends with.
+    """
 
-        # Read the file size chunk first:
-        file_length_field = in_fptr.read(_FILE_LENGTH_FIELD_SIZE)
-        origsize = struct.unpack('<Q', file_length_field)[0]
+    _check_chunksize(chunksize)
 
-        iv = in_fptr.read(_IV_SIZE)
-        decryptor = AES.new(key, AES.MODE_CBC, iv)
+    # Read the format marker and version first:
+    preamble = _read_field(in_fptr, _PREAMBLE.size, 'format marker')
+    marker, version = _PREAMBLE.unpack(preamble)
 
-        with open(out_filename, 'wb') as out_fptr:
-            while True:
-                chunk = in_fptr.read(chunksize)
-                if len(chunk) == 0:
-                    break
-                out_fptr.write(decryptor.decrypt(chunk))
+    if marker != _FORMAT_MARKER:
+        # Version 1, which starts with the plaintext length.
+        origsize = _FILE_LENGTH_FIELD.unpack(preamble)[0]
+        _decrypt_legacy_stream(key, origsize, in_fptr, out_fptr, chunksize)
+        return
+
+    if version != _FORMAT_VERSION:
+        raise errors.UnsupportedFormatError(
+            'Unsupported encrypted data format version {}.'.format(version)
+            )
+
+    file_length_field = _read_field(
+        in_fptr, _FILE_LENGTH_FIELD_SIZE, 'length field'
+        )
+    origsize = _FILE_LENGTH_FIELD.unpack(file_length_field)[0]
+
+    iv = _read_field(in_fptr, _IV_SIZE, 'nonce')
+    decryptor = _new_cipher_context(key, iv, decrypt=True)
+
+    transformed = _transform_stream(
+        in_fptr, out_fptr, decryptor.update_into, chunksize, size=origsize
+        )
+    if transformed < origsize:
+        raise errors.DecryptionError(
+            'Encrypted data is truncated in its ciphertext.'
+            )
+
+    tag = _read_field(in_fptr, _TAG_SIZE, 'tag')
+
+    try:
+        out_fptr.write(decryptor.finalize_with_tag(tag))
+    except _AUTHENTICATION_ERRORS:
+        raise errors.DecryptionError('Decryption failed authentication.')
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def _decrypt_legacy_stream(key, origsize, in_fptr, out_fptr, chunksize):
+    """Decrypt version 1 data, after its length field, to the end of in_fptr.
+
+    Raises errors.DecryptionError if the data does not end with a whole
+    block holding origsize, i.e. for a wrong key or a truncated file.
+    """
+
+    iv = _read_field(in_fptr, _IV_SIZE, 'IV')
+    decrypt = _new_legacy_decryptor(key, iv)
+
+    remaining = origsize
+    last_block = b''
+    while True:
+        chunk = _read_exactly(in_fptr, chunksize)
+        if not chunk:
+            break
+        if len(chunk) % _AES_BLOCK_SIZE != 0:
+            raise errors.DecryptionError('Legacy ciphertext is truncated.')
+
+        plaintext = decrypt(chunk)
+        if remaining:
+            _write_all(out_fptr, plaintext[:remaining])
+            remaining -= min(remaining, len(plaintext))
+        last_block = plaintext[-_AES_BLOCK_SIZE:]
+
+    if remaining or last_block[-_FILE_LENGTH_FIELD_SIZE:] != (
+            _FILE_LENGTH_FIELD.pack(origsize)
+            ):
+        raise errors.DecryptionError('Decryption failed authentication.')
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+class EncryptingWriter(object):
+    """Write-only file object encrypting what is written to it.
+
+    The output has the same layout as encrypt_file output, so it can be
+    read back with decrypt_file or decrypt_stream. The plaintext length is
+    not known in advance, so out_fptr must be seekable: a placeholder
+    length is written first and filled in by close().
+
+    This allows e.g. a streaming tarfile to be encrypted as it is written,
+    without first writing the plaintext archive to disk.
+    """
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def __init__(self, key, out_fptr):
+        """Initialize an EncryptingWriter instance.
+
+        Arguments:
+
+            key
+                The encryption key, as for encrypt_file.
+
+            out_fptr
+                A seekable binary file object, positioned where the
+                encrypted data should start.
+
+        """
+
+        iv = os.urandom(_IV_SIZE)
+
+        self._encryptor = _new_cipher_context(key, iv)
+        self._out_fptr = out_fptr
+        self._start = out_fptr.tell()
+        self._length = 0
+        self.closed = False
+
+        out_fptr.write(_header(0, iv))
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def __enter__(self):
+        return self
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def write(self, data):
+        """Encrypt data and write it to the output file object."""
+        self._out_fptr.write(self._encryptor.update(data))
+        self._length += len(data)
+        return len(data)
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def close(self):
+        """Write the GCM tag and fill in the plaintext length.
+
+        The output file object is left open, positioned after the tag.
+        """
+        if self.closed:
+            return
+        self.closed = True
 
-            out_fptr.truncate(origsize)
+        self._out_fptr.write(self._encryptor.finalize())
+        self._out_fptr.write(self._encryptor.tag)
+        end = self._out_fptr.tell()
+        self._out_fptr.seek(self._start + _LENGTH_OFFSET)
+        self._out_fptr.write(_FILE_LENGTH_FIELD.pack(self._length))
+        self._out_fptr.seek(end)
@@ -3,10 +3,16 @@
 Tools for working with Amazon KMS.
 """
 
+import concurrent.futures
+import functools
+import io
 import logging
 import os
+import re
+import shutil
 import tarfile
 import tempfile
+import time
 
 import boto3
 import click
@@ -18,6 +24,336 @@ HTTP_OK = 200
 
 _logger = logging.getLogger(__name__)
 
+# A name, optionally followed by an envelope suffix and then an archive
+# suffix. These describe names for the user's benefit only: envelopes are
+# still written as '<name>.kms-envelope.tgz', with members named by
+# _create_envelope, since stripping suffixes cannot round trip a basename
+# that itself ends in one of them.
+_FILENAME_RE = re.compile(
+    r'(?P<base>.+?)(?:\.(?P<envelope>kms-envelope))?'
+    r'(?:\.(?P<archive>tgz|kms-tgz))?',
+    re.DOTALL
+    )
+
+# The suffix of each kind of name, keyed by (is_envelope, is_archive).
+_FILENAME_SUFFIXES = {
+    (False, False): '',
+    (False, True): '.tgz',
+    (True, False): '.kms-envelope',
+    (True, True): '.kms-envelope.kms-tgz',
+    }
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+@functools.lru_cache(maxsize=None)
+def _kms_client(profile_name=None, region_name=None):
+    """Return a KMS client for the profile and region, creating it once.
+
+    Building a session re-reads the AWS configuration and credentials and
+    each new client opens its own connections, so clients are shared by all
+    KmsAgent instances in the process. boto3 clients are thread-safe.
+    """
+    # We pass any not-None parameters from the pair.
+    # TODO: deprecated. Expect environment.
+    kwargs = dict([
+        (u, v)
+        for u, v in [
+            ('profile_name', profile_name),
+            ('region_name', region_name)
+            ]
+        if v is not None
+        ])
+    session = boto3.session.Session(**kwargs)
+    return session.client('kms')
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+@functools.lru_cache(maxsize=128)
+def _decrypt_ciphertext_blob(kms_client, ciphertext_blob):
+    """Return (key_id, data_key) for ciphertext_blob from AWS KMS.
+
+    Results are cached, so agents rebuilt from the same ciphertext blob,
+    e.g. when opening many envelopes sealed by one agent, cost a single
+    KMS Decrypt call. Failed calls raise and so are not cached. The
+    cache keeps plaintext data keys in process memory, and a key is
+    still usable after it has been disabled in KMS; call
+    _decrypt_ciphertext_blob.cache_clear() to drop them.
+    """
+    response = kms_client.decrypt(
+        CiphertextBlob=ciphertext_blob
+        )
+
+    response_metadata = response['ResponseMetadata']
+    status_code = response_metadata['HTTPStatusCode']
+    if status_code != HTTP_OK:
+        msg = "HTTP {} response to AWS KMS decrypt() call {}."
+        _logger.error(msg, status_code, response_metadata['RequestId'])
+        raise errors.KmsAwsConnectionError(msg.format(
+            status_code, response_metadata['RequestId']
+            ))
+
+    return response['KeyId'], response['Plaintext']
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def _rename(name, is_envelope, is_archive):
+    """Return name with its suffixes replaced by those of the given kind.
+
+    Raises ValueError if name is empty.
+    """
+    match = _FILENAME_RE.fullmatch(name)
+    if match is None:
+        raise ValueError('Not a valid file name: {!r}.'.format(name))
+
+    base = match.group('base')
+    return base + _FILENAME_SUFFIXES[(is_envelope, is_archive)]
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def plain_name(name):
+    """Return the plaintext name for any of the forms of name.
+
+    For example, 'plaintext' for 'plaintext.kms-envelope.kms-tgz'.
+    """
+    return _rename(name, False, False)
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def archive_name(name):
+    """Return the archive name, '<plain name>.tgz', for name."""
+    return _rename(name, False, True)
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def envelope_name(name):
+    """Return the envelope name, '<plain name>.kms-envelope', for name."""
+    return _rename(name, True, False)
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def envelope_archive_name(name):
+    """Return the envelope archive name for name.
+
+    That is '<plain name>.kms-envelope.kms-tgz'.
+    """
+    return _rename(name, True, True)
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def _new_tarinfo(name, size=None):
+    """Return a TarInfo for an archive member not backed by a file.
+
+    A directory member is described if size is None, otherwise a regular
+    file member of the given size.
+    """
+    tarinfo = tarfile.TarInfo(name)
+    tarinfo.mtime = time.time()
+
+    if size is None:
+        tarinfo.type = tarfile.DIRTYPE
+        tarinfo.mode = 0o755
+    else:
+        tarinfo.size = size
+        tarinfo.mode = 0o644
+
+    return tarinfo
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def _envelope_path(plaintext_path, output_path=None):
+    """Return the path _create_envelope writes the envelope of plaintext_path.
+
+    As for _create_envelope, output_path is a directory to create the
+    envelope in, the envelope file path itself, or None to create it
+    beside plaintext_path.
+    """
+
+    if output_path is None:
+        output_path = os.path.dirname(plaintext_path) or '.'
+
+    if os.path.isdir(output_path):
+        output_tar_name = '.'.join(
+            [os.path.basename(plaintext_path), 'kms-envelope', 'tgz']
+            )
+        return os.path.join(output_path, output_tar_name)
+
+    return output_path
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def _create_envelope(agent, plaintext_path, output_path=None):
+    """Create an envelope of plaintext_path with the keys of KmsAgent agent.
+
+    This implements KmsAgent.create_envelope and Enveloper.create_envelope.
+    """
+
+    # Create a temporary file to hold the encrypted archive.
+    # Create a tar archive of source, encrypting it into the temporary
+    # file as it is written.
+    # Create a tar archive of source.key-envelope in output path, holding
+    # the ciphertext blob and the encrypted archive.
+    # The plaintext only passes through memory, never through a file.
+
+    input_basename = os.path.basename(plaintext_path)
+    envelope_name = '.'.join([input_basename, 'kms-envelope'])
+    input_tar_name = '.'.join([input_basename, 'tgz'])
+    encrypted_tar_name = '.'.join([input_tar_name, 'encrypt'])
+
+    blob_member_name = '/'.join([envelope_name, 'ciphertext-blob'])
+    encrypted_tar_member_name = '/'.join(
+        [envelope_name, encrypted_tar_name]
+        )
+
+    output_tar_path = _envelope_path(plaintext_path, output_path)
+
+    # - - - - - - - - - - - - - - - - - - - - - - - -
+    # Paths calculated, let's get to work.
+    # - - - - - - - - - - - - - - - - - - - - - - - -
+    # Create a temporary file to hold the encrypted archive.
+    with tempfile.TemporaryFile() as encrypted_tar_fptr:
+
+        # Create a tar archive of source, encrypting it into the temporary
+        # file as it is written.
+        with _engine.EncryptingWriter(
+                agent.data_key, encrypted_tar_fptr
+                ) as encrypting_writer:
+            with tarfile.open(
+                    fileobj=encrypting_writer, mode='w|gz'
+                    ) as source_tar_archive:
+                # Use basename as arcname to prevent the archive element
+                # from being located under the full path in the original
+                # filesystem.
+                source_tar_archive.add(
+                    plaintext_path,
+                    arcname=input_basename
+                    )
+
+        encrypted_tar_size = encrypted_tar_fptr.tell()
+        encrypted_tar_fptr.seek(0)
+
+        # Create a tar archive of source.key-envelope in output path.
+        # It is not compressed: its contents are ciphertext, which gzip
+        # cannot shrink, so compressing would only cost a second pass over
+        # the data. The .tgz name is kept for compatibility.
+        with tarfile.open(output_tar_path, 'w|') as output_archive:
+            output_archive.addfile(_new_tarinfo(envelope_name))
+            output_archive.addfile(
+                _new_tarinfo(
+                    blob_member_name, len(agent.ciphertext_blob)
+                    ),
+                io.BytesIO(agent.ciphertext_blob)
+                )
+            output_archive.addfile(
+                _new_tarinfo(
+                    encrypted_tar_member_name, encrypted_tar_size
+                    ),
+                encrypted_tar_fptr
+                )
+
+    return output_tar_path
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def _open_envelope(input_path, output_path=None, kms_client=None):
+    """Obtain the plaintext of the envelope input_path.
+
+    This implements KmsAgent.open_envelope and Enveloper.open_envelope.
+    kms_client is passed on to the KmsAgent that decrypts the ciphertext
+    blob.
+    """
+
+    if output_path is None:
+        output_path = os.path.dirname(input_path) or '.'
+
+    # Untar envelope_path as a stream.
+    # Create a KmsAgent instance with the ciphertext_blob.
+    # Unencrypt the encrypted archive into a temporary file.
+    # Untar the unencrypted archive to the output path.
+    # The unencrypted archive is only untarred once it has been
+    # authenticated, so a tampered envelope writes nothing to output_path.
+
+    agent = None
+    ciphertext_blob = None
+    encrypted_archive_filename = None
+
+    with tempfile.TemporaryFile() as decrypted_archive_fptr:
+        with tempfile.TemporaryFile() as encrypted_archive_fptr:
+
+            # Untar envelope_path as a stream. Envelopes created by older
+            # versions are gzipped; 'r|*' detects the compression.
+            with tarfile.open(input_path, 'r|*') as input_tar_archive:
+                for member in input_tar_archive:
+                    # Member names are fixed by _create_envelope; the
+                    # plain_name() etc. helpers are not used to parse them.
+                    member_name = os.path.basename(member.name)
+
+                    if member_name == 'ciphertext-blob':
+                        ciphertext_blob = input_tar_archive.extractfile(
+                            member
+                            ).read()
+
+                    elif member_name.split('.')[-1] == 'encrypt':
+                        encrypted_archive_filename = member_name
+                        member_fptr = input_tar_archive.extractfile(
+                            member
+                            )
+
+                        if ciphertext_blob is None:
+                            # Envelopes created by cryptkeeper 1.x list
+                            # their members in name order, so the
+                            # encrypted archive of a plaintext named
+                            # before 'ciphertext-blob' comes first; keep
+                            # it until we have the key.
+                            shutil.copyfileobj(
+                                member_fptr, encrypted_archive_fptr
+                                )
+                            continue
+
+                        # Create a KmsAgent instance with the
+                        # ciphertext_blob.
+                        agent = KmsAgent(
+                            ciphertext_blob=ciphertext_blob,
+                            kms_client=kms_client
+                            )
+
+                        # Unencrypt the encrypted archive straight from
+                        # the envelope.
+                        _engine.decrypt_stream(
+                            agent.data_key,
+                            member_fptr,
+                            decrypted_archive_fptr
+                            )
+
+            # TODO: Ugh, no error checking!
+            if agent is None:
+                agent = KmsAgent(
+                    ciphertext_blob=ciphertext_blob, kms_client=kms_client
+                    )
+                encrypted_archive_fptr.seek(0)
+                _engine.decrypt_stream(
+                    agent.data_key,
+                    encrypted_archive_fptr,
+                    decrypted_archive_fptr
+                    )
+
+        # Untar the unencrypted archive to the output path.
+        # TODO: This just assumes output_path is a directory.
+        decrypted_archive_fptr.seek(0)
+        with tarfile.open(
+                fileobj=decrypted_archive_fptr, mode='r|gz'
+                ) as output_archive:
+            output_archive.extractall(path=output_path)
+
+    decrypted_archive_filename = os.path.splitext(
+        encrypted_archive_filename
+        )[0]
+
+    # TODO: This assumes so much...
+    return os.path.join(
+        output_path,
+        os.path.splitext(decrypted_archive_filename)[0]
+        )
+
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 class KmsAgent(object):
@@ -31,6 +367,7 @@ class KmsAgent(object):
             ciphertext_blob=None,
             profile_name=None,  # TODO: deprecated. Expect environment.
             region_name=None,  # TODO: deprecated. Expect environment.
+            kms_client=None,
             ):
         """Initialize a KmsAgent instance.
 
@@ -51,6 +388,10 @@ class KmsAgent(object):
             region_name
                 XXX  # TODO: deprecated. Expect environment.
 
+            kms_client
+                A boto3 KMS client to use instead of the shared one for
+                profile_name and region_name, e.g. to reuse a client
+                and its connections across agents.
 
         """
 
@@ -59,12 +400,18 @@ class KmsAgent(object):
         # while master_key_id can be defined with or without data_key but
         # is required if data_key is defined.
         msg = None
-        if list({master_key_id, data_key, ciphertext_blob}) == [None]:
+        if (
+                master_key_id is None
+                and data_key is None
+                and ciphertext_blob is None
+                ):
             msg = (
                 'At least one of master_key_id, data_key and ciphertext_blob'
                 ' is required.'
                 )
-        if ciphertext_blob and list({master_key_id, data_key}) != [None]:
+        if ciphertext_blob and (
+                master_key_id is not None or data_key is not None
+                ):
             msg = (
                 'If ciphertext_blob is defined, master_key_id and data_key'
                 ' must be undefined.'
@@ -77,7 +424,7 @@ class KmsAgent(object):
             raise errors.KmsHelperInitializationError(msg)
 
         # - - - - - - - - - - - - - - - - - - - - - - - -
-        self._kms_client = None
+        self._kms_client = kms_client
 
         # This could also be an alias.
         self._master_key_id = master_key_id
@@ -93,24 +440,14 @@ class KmsAgent(object):
             # - - - - - - - - - - - - - - - - - - - - - - - -
             # We have only a ciphertext blob. We pass it to AWS KMS to decrypt
             # it from which we obtain our master_key_id and data_key.
+            # Repeated blobs are answered from a cache, which needs a
+            # hashable blob.
             # - - - - - - - - - - - - - - - - - - - - - - - -
 
-            response = self.kms_client.decrypt(
-                CiphertextBlob=ciphertext_blob
+            self._master_key_id, self._data_key = _decrypt_ciphertext_blob(
+                self.kms_client, bytes(ciphertext_blob)
                 )
 
-            response_metadata = response['ResponseMetadata']
-            status_code = response_metadata['HTTPStatusCode']
-            if status_code != HTTP_OK:
-                msg = "HTTP {} response to AWS KMS decrypt() call {}."
-                _logger.error(msg, status_code, response_metadata['RequestId'])
-                raise errors.KmsAwsConnectionError(msg.format(
-                    status_code, response_metadata['RequestId']
-                    ))
-
-            self._master_key_id = response['KeyId']
-            self._data_key = response['Plaintext']
-
         elif self._data_key:
             # - - - - - - - - - - - - - - - - - - - - - - - -
             # We already checked above that master_key_id is defined. We pass
@@ -173,18 +510,9 @@ class KmsAgent(object):
     def kms_client(self):
         """Return the kms_client"""
         if self._kms_client is None:
-            # We pass any not-None parameters from the pair.
-            # TODO: deprecated. Expect environment.
-            kwargs = dict([
-                (u, v)
-                for u, v in [
-                    ('profile_name', self.profile_name),
-                    ('region_name', self.region_name)
-                    ]
-                if v is not None
-                ])
-            session = boto3.session.Session(**kwargs)
-            self._kms_client = session.client('kms')
+            self._kms_client = _kms_client(
+                self.profile_name, self.region_name
+                )
 
         return self._kms_client
 
@@ -224,91 +552,18 @@ class KmsAgent(object):
             output_path
                 XXX
 
-        The envelope will be a .tgz archive of a directory containing the
-        KmsAgent's ciphertext blob and the encryption of an "internal" .tgz
-        archive of the file or directory specified in the
-        `plaintext_path` parameter.
+        The envelope will be an uncompressed tar archive, named .tgz, of a
+        directory containing the KmsAgent's ciphertext blob and the
+        encryption of an "internal" .tgz archive of the file or directory
+        specified in the `plaintext_path` parameter.
 
         """
 
-        if output_path is None:
-            output_path = os.path.dirname(plaintext_path) or '.'
-
-        # Create a temporary working directory to build the envelope.
-        # Create source.key-envelope in the temporary directory.
-        # Create a tar archive of source in the temporary directory.
-        # Write the ciphertext blob into source.key-envelope.
-        # Encrypt the tar archive into source.key-envelope.
-        # Create a tar archive of source.key-envelope in output path.
-        # Remove the temporary directory.
-
-        input_basename = os.path.basename(plaintext_path)
-        envelope_name = '.'.join([input_basename, 'kms-envelope'])
-        tmp_input_tar_name = '.'.join([input_basename, 'tgz'])
-        tmp_encrypted_tar_name = '.'.join([tmp_input_tar_name, 'encrypt'])
-
-        # Create a temporary working directory to build the envelope.
-        tmpdir = tempfile.mkdtemp()
-
-        tmp_envelope_path = os.path.join(tmpdir, envelope_name)
-        tmp_input_tar_path = os.path.join(tmpdir, tmp_input_tar_name)
-        blob_path = os.path.join(tmp_envelope_path, 'ciphertext-blob')
-        encrypted_tar_path = os.path.join(
-            tmp_envelope_path,
-            tmp_encrypted_tar_name
-            )
-
-        if os.path.isdir(output_path):
-            output_tar_name = '.'.join([envelope_name, 'tgz'])
-            output_tar_path = os.path.join(output_path, output_tar_name)
-        else:
-            output_tar_path = output_path
-
-        # - - - - - - - - - - - - - - - - - - - - - - - -
-        # Paths calculated, let's get to work.
-        # - - - - - - - - - - - - - - - - - - - - - - - -
-        # Create source.key-envelope in the temporary directory.
-        os.mkdir(tmp_envelope_path)
-
-        # Create a tar archive of source in the temporary directory.
-        with tarfile.open(tmp_input_tar_path, 'w:gz') as source_tar_archive:
-            # Use basename as arcname to prevent the archive element from being
-            # located under the full path in the original filesystem.
-            source_tar_archive.add(
-                plaintext_path,
-                arcname=os.path.basename(plaintext_path)
-                )
-
-        # Write the ciphertext blob into source.key-envelope.
-        with open(blob_path, 'wb') as fptr:
-            fptr.write(self.ciphertext_blob)
-
-        # Encrypt the tar archive into source.key-envelope.
-        _engine.encrypt_file(self.data_key, tmp_input_tar_path,
-                             encrypted_tar_path)
-
-        # Create a tar archive of source.key-envelope in output path.
-        with tarfile.open(output_tar_path, 'w:gz') as output_archive:
-            output_archive.add(
-                tmp_envelope_path,
-                arcname=os.path.basename(tmp_envelope_path)
-                )
-
-        # - - - - - - - - - - - - - - - - - - - - - - - -
-        # Remove the temporary directory.
-        # - - - - - - - - - - - - - - - - - - - - - - - -
-        for root, dirs, files in os.walk(tmpdir, topdown=False):
-            for name in files:
-                os.remove(os.path.join(root, name))
-            for name in dirs:
-                os.rmdir(os.path.join(root, name))
-        os.rmdir(tmpdir)
-
-        return output_tar_path
+        return _create_envelope(self, plaintext_path, output_path)
 
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     @classmethod
-    def open_envelope(self, input_path, output_path):
+    def open_envelope(self, input_path, output_path=None, kms_client=None):
         """Obtain the plaintext of the contents of envelope_path.
 
         Arguments:
@@ -319,79 +574,13 @@ class KmsAgent(object):
             output_path
                 XXX
 
-        """
-
-        if output_path is None:
-            output_path = os.path.dirname(plaintext_path) or '.'
-
-        # Create a temporary working directory to build the envelope.
-        # Untar envelope_path into the temporary directory.
-        # Create a KmsAgent instance with the ciphertext_blob.
-        # Unencrypt the encrypted file into the temporary directory.
-        # Untar the unencrypted file to the output path.
-        # Remove the temporary directory.
-
-        # Create a temporary working directory to build the envelope.
-        tmpdir = tempfile.mkdtemp()
-
-        # input_tar_name = os.path.basename(input_path)
-        # input_tar_path = os.path.join(tmpdir, input_tar_name)
-
-        # Untar envelope_path into the temporary directory.
-        # tmp_envelope_name = '.'.join([input_tar_name, 'untarred'])
-        # tmp_envelope_path = os.path.join(tmpdir, tmp_envelope_name)
-        with tarfile.open(input_path, 'r:gz') as input_tar_archive:
-            input_tar_archive.extractall(path=tmpdir)
-
-        # TODO: Use filename manipulation methods.
-        kms_envelope_path = os.path.join(tmpdir, os.listdir(tmpdir)[0])
-        ciphertext_blob_path = os.path.join(
-            kms_envelope_path, 'ciphertext-blob'
-            )
-
-        # Create a KmsAgent instance with the ciphertext_blob.
-        with open(ciphertext_blob_path, 'rb') as fptr:
-            ciphertext_blob = fptr.read()
-        agent = KmsAgent(ciphertext_blob=ciphertext_blob)
+            kms_client
+                As for KmsAgent.
 
-        # Unencrypt the encrypted file into the temporary directory.
-        encrypted_archive_list = [
-            f for f in os.listdir(kms_envelope_path) if f.split('.')[-1] == 'encrypt'
-            ]
-        # TODO: Ugh, no error checking!
-        encrypted_archive_filename = encrypted_archive_list[0]
-        decrypted_archive_filename = os.path.splitext(
-            encrypted_archive_filename
-            )[0]
-        decrypted_archive_path = os.path.join(
-            tmpdir, decrypted_archive_filename
-            )
-        _engine.decrypt_file(
-            agent.data_key,
-            os.path.join(kms_envelope_path, encrypted_archive_filename),
-            out_filename=decrypted_archive_path
-            )
+        """
 
-        # Untar the unencrypted file to the output path.
-        # TODO: This just assumes output_path is a directory.
-        with tarfile.open(decrypted_archive_path, 'r:gz') as output_archive:
-            output_archive.extractall(path=output_path)
+        return _open_envelope(input_path, output_path, kms_client=kms_client)
 
-        # - - - - - - - - - - - - - - - - - - - - - - - -
-        # Remove the temporary directory.
-        # - - - - - - - - - - - - - - - - - - - - - - - -
-        for root, dirs, files in os.walk(tmpdir, topdown=False):
-            for name in files:
-                os.remove(os.path.join(root, name))
-            for name in dirs:
-                os.rmdir(os.path.join(root, name))
-        os.rmdir(tmpdir)
-
-        # TODO: This assumes so much...
-        return os.path.join(
-            output_path,
-            os.path.splitext(os.path.basename(decrypted_archive_path))[0]
-            )
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 class Enveloper(object):
@@ -431,90 +620,89 @@ class Enveloper(object):
             output_path
                 XXX
 
-        The envelope will be a .tgz archive of a directory containing the
-        KmsAgent's ciphertext blob and the encryption of an "internal" .tgz
-        archive of the file or directory specified in the
-        `plaintext_path` parameter.
+        The envelope will be an uncompressed tar archive, named .tgz, of a
+        directory containing the KmsAgent's ciphertext blob and the
+        encryption of an "internal" .tgz archive of the file or directory
+        specified in the `plaintext_path` parameter.
 
         """
 
-        # TODO: Move to this code for envelopes, instead of in KmsAgent.
+        if self._active_agent is None:
+            msg = 'An Enveloper needs a kms_agent to create envelopes.'
+            _logger.error(msg)
+            raise errors.KmsHelperInitializationError(msg)
 
-        # Create a temporary working directory to build the envelope.
-        # Create source.key-envelope in the temporary directory.
-        # Create a tar archive of source in the temporary directory.
-        # Write the ciphertext blob into source.key-envelope.
-        # Encrypt the tar archive into source.key-envelope.
-        # Create a tar archive of source.key-envelope in output path.
-        # Remove the temporary directory.
-
-        input_basename = os.path.basename(plaintext_path)
-        envelope_name = '.'.join([input_basename, 'kms-envelope'])
-        tmp_input_tar_name = '.'.join([input_basename, 'tgz'])
-        tmp_encrypted_tar_name = '.'.join([tmp_input_tar_name, 'encrypt'])
-
-        # Create a temporary working directory to build the envelope.
-        tmpdir = tempfile.mkdtemp()
-
-        tmp_envelope_path = os.path.join(tmpdir, envelope_name)
-        tmp_input_tar_path = os.path.join(tmpdir, tmp_input_tar_name)
-        blob_path = os.path.join(tmp_envelope_path, 'ciphertext-blob')
-        encrypted_tar_path = os.path.join(
-            tmp_envelope_path,
-            tmp_encrypted_tar_name
+        return _create_envelope(
+            self._active_agent, plaintext_path, output_path
             )
 
-        if os.path.isdir(output_path):
-            output_tar_name = '.'.join([envelope_name, 'tgz'])
-            output_tar_path = os.path.join(output_path, output_tar_name)
-        else:
-            output_tar_path = output_path
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def create_envelopes(
+            self, plaintext_paths, output_path=None, max_workers=None
+            ):
+        """Create an envelope for each of several sources, in parallel.
 
-        # - - - - - - - - - - - - - - - - - - - - - - - -
-        # Paths calculated, let's get to work.
-        # - - - - - - - - - - - - - - - - - - - - - - - -
-        # Create source.key-envelope in the temporary directory.
-        os.mkdir(tmp_envelope_path)
-
-        # Create a tar archive of source in the temporary directory.
-        with tarfile.open(tmp_input_tar_path, 'w:gz') as source_tar_archive:
-            # Use basename as arcname to prevent the archive element from being
-            # located under the full path in the original filesystem.
-            source_tar_archive.add(
-                plaintext_path,
-                arcname=os.path.basename(plaintext_path)
-                )
+        Arguments:
 
-        # Write the ciphertext blob into source.key-envelope.
-        with open(blob_path, 'wb') as fptr:
-            fptr.write(self.ciphertext_blob)
+            plaintext_paths
+                The files or directories to create envelopes for.
 
-        # Encrypt the tar archive into source.key-envelope.
-        _engine.encrypt_file(self.data_key, tmp_input_tar_path,
-                             encrypted_tar_path)
+            output_path
+                The directory to create the envelopes in. If None, each
+                envelope is created beside its source.
 
-        # Create a tar archive of source.key-envelope in output path.
-        with tarfile.open(output_tar_path, 'w:gz') as output_archive:
-            output_archive.add(
-                tmp_envelope_path,
-                arcname=os.path.basename(tmp_envelope_path)
-                )
+            max_workers
+                The maximum number of envelopes created at once, as for
+                concurrent.futures.ThreadPoolExecutor.
 
-        # - - - - - - - - - - - - - - - - - - - - - - - -
-        # Remove the temporary directory.
-        # - - - - - - - - - - - - - - - - - - - - - - - -
-        for root, dirs, files in os.walk(tmpdir, topdown=False):
-            for name in files:
-                os.remove(os.path.join(root, name))
-            for name in dirs:
-                os.rmdir(os.path.join(root, name))
-        os.rmdir(tmpdir)
+        The envelopes are independent, so they are created in a thread pool;
+        their file I/O, compression and encryption then overlap. All of them
+        use the Enveloper's kms_agent key material. Returns the envelope
+        paths in the order of plaintext_paths.
+
+        Raises ValueError, before creating any envelope, if two sources
+        would have the same envelope path, e.g. 'a/x' and 'b/x' with one
+        output_path.
+
+        """
 
-        return output_tar_path
+        if self._active_agent is None:
+            msg = 'An Enveloper needs a kms_agent to create envelopes.'
+            _logger.error(msg)
+            raise errors.KmsHelperInitializationError(msg)
+
+        if output_path is not None and not os.path.isdir(output_path):
+            raise ValueError(
+                'output_path must be a directory, not {}.'.format(output_path)
+                )
+
+        plaintext_paths = list(plaintext_paths)
+        envelope_paths = set()
+        for plaintext_path in plaintext_paths:
+            envelope_path = os.path.realpath(
+                _envelope_path(plaintext_path, output_path)
+                )
+            if envelope_path in envelope_paths:
+                msg = 'More than one source would be enveloped as {}.'.format(
+                    envelope_path
+                    )
+                _logger.error(msg)
+                raise ValueError(msg)
+            envelope_paths.add(envelope_path)
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_workers
+                ) as executor:
+            return list(executor.map(
+                lambda plaintext_path: _create_envelope(
+                    self._active_agent, plaintext_path, output_path
+                    ),
+                plaintext_paths
+                ))
 
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     @classmethod
-    def open_envelope(cls, input_path, output_path):
+    def open_envelope(cls, input_path, output_path=None, kms_client=None):
         """Obtain the plaintext of the contents of envelope_path.
 
         Arguments:
@@ -525,129 +713,14 @@ class Enveloper(object):
             output_path
                 XXX
 
-        """
-
-        # TODO: Move to this code for envelopes, instead of in KmsAgent.
-
-        # Create a temporary working directory to build the envelope.
-        # Untar envelope_path into the temporary directory.
-        # Create a KmsAgent instance with the ciphertext_blob.
-        # Unencrypt the encrypted file into the temporary directory.
-        # Untar the unencrypted file to the output path.
-        # Remove the temporary directory.
-
-        # Create a temporary working directory to build the envelope.
-        tmpdir = tempfile.mkdtemp()
-
-        # input_tar_name = os.path.basename(input_path)
-        # input_tar_path = os.path.join(tmpdir, input_tar_name)
-
-        # Untar envelope_path into the temporary directory.
-        # tmp_envelope_name = '.'.join([input_tar_name, 'untarred'])
-        # tmp_envelope_path = os.path.join(tmpdir, tmp_envelope_name)
-        with tarfile.open(input_path, 'r:gz') as input_tar_archive:
-            input_tar_archive.extractall(path=tmpdir)
-
-        # TODO: Use filename manipulation methods.
-        kms_envelope_path = os.path.join(tmpdir, os.listdir(tmpdir)[0])
-        ciphertext_blob_path = os.path.join(
-            kms_envelope_path, 'ciphertext-blob'
-            )
-
-        # Create a KmsAgent instance with the ciphertext_blob.
-        with open(ciphertext_blob_path, 'rb') as fptr:
-            ciphertext_blob = fptr.read()
-        agent = KmsAgent(ciphertext_blob=ciphertext_blob)
-
-        # Unencrypt the encrypted file into the temporary directory.
-        encrypted_archive_list = [
-            f for f in os.listdir(kms_envelope_path) if f.split('.')[-1] == 'encrypt'
-            ]
-        # TODO: Ugh, no error checking!
-        encrypted_archive_filename = encrypted_archive_list[0]
-        decrypted_archive_filename = os.path.splitext(
-            encrypted_archive_filename
-            )[0]
-        decrypted_archive_path = os.path.join(
-            tmpdir, decrypted_archive_filename
-            )
-        _engine.decrypt_file(
-            agent.data_key,
-            os.path.join(kms_envelope_path, encrypted_archive_filename),
-            out_filename=decrypted_archive_path
-            )
-
-        # Untar the unencrypted file to the output path.
-        # TODO: This just assumes output_path is a directory.
-        with tarfile.open(decrypted_archive_path, 'r:gz') as output_archive:
-            output_archive.extractall(path=output_path)
-
-        # - - - - - - - - - - - - - - - - - - - - - - - -
-        # Remove the temporary directory.
-        # - - - - - - - - - - - - - - - - - - - - - - - -
-        for root, dirs, files in os.walk(tmpdir, topdown=False):
-            for name in files:
-                os.remove(os.path.join(root, name))
-            for name in dirs:
-                os.rmdir(os.path.join(root, name))
-        os.rmdir(tmpdir)
-
-        # TODO: This assumes so much...
-        return os.path.join(
-            output_path,
-            os.path.splitext(os.path.basename(decrypted_archive_path))[0]
-            )
+            kms_client
+                As for KmsAgent.
 
+        """
 
-# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-@click.command()
-@click.option(
-    '-b', '--ciphertext-blob', metavar="/PATH/TO/BLOB",
-    help='The path to the ciphertext blob to use.')
-@click.option(
-    '-d', '--data-key',
-    help='The data key to use.'
-    )
-@click.option(
-    '-m', '--master-key-id',
-    help='The KMS master key ID to use.'
-    )
-@click.option(
-    '-o', '--output_path', metavar="/PATH/TO/OUTPUT",
-    help='The desired output path.'
-    )
-@click.option(
-    '--profile_name',
-    help='The AWS profile name.'
-    )
-@click.option(
-    '--region_name',
-    help='The AWS region name.'
-    )
-@click.argument('plaintext')
-def create_envelope(
-        ciphertext_blob,
-        data_key,
-        master_key_id,
-        output_path,
-        profile_name,
-        region_name,
-        plaintext
-        ):
-    """Create a KMS data envelope protecting PLAINTEXT.
+        return _open_envelope(input_path, output_path, kms_client=kms_client)
 
-    PLAINTEXT can be the path to either a file or a directory.
-    """
 
-    # TODO: This seems to silently fail when PLAINTEXT ends with '/'.
-    agent = KmsAgent(
-        master_key_id=master_key_id,
-        data_key=data_key,
-        ciphertext_blob=ciphertext_blob,
-        profile_name=profile_name,
-        region_name=region_name
-        )
-    agent.create_envelope(plaintext, output_path=output_path)
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 @click.command()
 @click.option(
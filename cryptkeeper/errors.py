@@ -8,12 +8,32 @@ cryptkeeper package errors.
 class CryptkeeperError(Exception):
     """Base class for all package errors."""
 
+    __slots__ = ()
+
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 class KmsHelperInitializationError(CryptkeeperError):
     """An error occurred in KMS Helper initialization."""
 
+    __slots__ = ()
+
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 class KmsAwsConnectionError(CryptkeeperError):
-    """An error occurred while connecting to AWS."""
\ No newline at end of file
+    """An error occurred while connecting to AWS."""
+
+    __slots__ = ()
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+class DecryptionError(CryptkeeperError):
+    """Ciphertext failed authentication during decryption."""
+
+    __slots__ = ()
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+class UnsupportedFormatError(CryptkeeperError):
+    """Encrypted data is in a format version this version cannot read."""
+
+    __slots__ = ()
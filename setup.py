@@ -12,11 +12,16 @@ from setuptools import find_packages
 from setuptools import setup
 
 
-install_requires=[
+install_requires = [
     'boto3>=1.7.25',
     'click>=6.7',
-    'pycryptodome>=3.6.4',
-    ],
+    'cryptography>=42',
+    ]
+
+# AES fallback for where cryptography cannot be installed.
+extras_require = {
+    'pycryptodome': ['pycryptodome>=3.7'],
+    }
 
 package_data={
     '': [
@@ -46,7 +51,7 @@ entry_points={
 
 setup(
     name="cryptkeeper",
-    version="1.0.1",
+    version="2.0.0",
     description="",
     author="Scott Brown",
     author_email='scottbrown0001@gmail.com',
@@ -54,6 +59,8 @@ setup(
     packages=find_packages(exclude=['test_*']),
     # package_data=package_data,
     # scripts=script_package_paths,
+    python_requires='>=3.7',
     install_requires=install_requires,
+    extras_require=extras_require,
     entry_points=entry_points,
     )
@@ -0,0 +1,32 @@
+"""Helpers shared by the test modules."""
+
+import hashlib
+import os
+
+# Keep test files in memory where tmpfs is available, so the tests exercise
+# the cipher rather than the disk.
+TMP_ROOT = (
+    '/dev/shm'
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK)
+    else None
+    )
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def digest(path):
+    """Return the SHA-256 digest of the contents of path."""
+    with open(path, 'rb', buffering=0) as fptr:
+        if hasattr(hashlib, 'file_digest'):  # Python 3.11+
+            return hashlib.file_digest(fptr, 'sha256').digest()
+
+        sha256 = hashlib.sha256()
+        for block in iter(lambda: fptr.read(1 << 18), b''):
+            sha256.update(block)
+        return sha256.digest()
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def write_payload(path, size, zeros=False):
+    """Write size random bytes, or zero bytes, to path with a single write."""
+    with open(path, 'wb', buffering=0) as fptr:
+        fptr.write(bytearray(size) if zeros else os.urandom(size))
@@ -1,14 +1,32 @@
 
 '''Test cases for the _engine.py module.'''
 
-import filecmp
+import contextlib
+import io
 import os
+import secrets
 import shutil
 import tempfile
 
+import struct
 import unittest
+from unittest import mock
+
+try:
+    from cryptography.hazmat.primitives.ciphers import algorithms
+    from cryptography.hazmat.primitives.ciphers import Cipher
+    from cryptography.hazmat.primitives.ciphers import modes
+except ImportError:
+    # The pycryptodome fallback, as in _engine.
+    Cipher = None
+    from Crypto.Cipher import AES
 
 from cryptkeeper import _engine
+from cryptkeeper import errors
+
+from _helpers import digest
+from _helpers import TMP_ROOT
+from _helpers import write_payload
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 # Uncomment to show lower level logging statements.
@@ -24,22 +42,53 @@ from cryptkeeper import _engine
 # shandler.setFormatter(formatter)
 # logger.addHandler(shandler)
 
+# Plaintext sizes the round trip tests are run with. The last is large
+# enough for encrypt_file to memory map the files, and is not a multiple of
+# the chunk size.
+PAYLOAD_SIZES = (4096, 1 << 20, _engine._MMAP_THRESHOLD + 4097)
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def write_legacy_ciphertext(key, plaintext, path):
+    '''Write plaintext to path encrypted as cryptkeeper 1.x did.
+
+    That is AES-CBC, padded with random bytes to a whole block (a whole
+    random block when already aligned) and a final block of 8 random bytes
+    and the plaintext length.
+    '''
+    iv = os.urandom(16)
+    padding = os.urandom(16 - len(plaintext) % 16)
+    trailer = os.urandom(8) + struct.pack('<Q', len(plaintext))
+    if Cipher is None:
+        encrypt = AES.new(key, AES.MODE_CBC, iv).encrypt
+    else:
+        encrypt = Cipher(
+            algorithms.AES(key), modes.CBC(iv)
+            ).encryptor().update
+    with open(path, 'wb') as fptr:
+        fptr.write(struct.pack('<Q', len(plaintext)) + iv)
+        fptr.write(encrypt(plaintext + padding + trailer))
+
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 class EngineTestBaseClass(unittest.TestCase):
     '''Common base class for Engine testing.'''
 
+    _tmp_ctx = None
+    tmpdir = None
+
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     @classmethod
     def setUpClass(cls):
         '''Test case class common fixture setup.'''
-        cls.tmpdir = tempfile.mkdtemp()
+        cls._tmp_ctx = tempfile.TemporaryDirectory(dir=TMP_ROOT)
+        cls.tmpdir = cls._tmp_ctx.name
 
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     @classmethod
     def tearDownClass(cls):
         '''Test case class common fixture teardown.'''
-        cls.clean_tmpdir()
-        os.rmdir(cls.tmpdir)
+        cls._tmp_ctx.cleanup()
 
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     def setUp(self):
@@ -49,18 +98,17 @@ class EngineTestBaseClass(unittest.TestCase):
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     @classmethod
     def clean_tmpdir(cls):
-        '''Remove all content from cls.tmpdir.'''
-        for root, dirs, files in os.walk(cls.tmpdir, topdown=False):
-            for name in files:
-                os.remove(os.path.join(root, name))
-            for name in dirs:
-                os.rmdir(os.path.join(root, name))
+        '''Replace cls.tmpdir with a new, empty directory.'''
+        cls._tmp_ctx.cleanup()
+        cls._tmp_ctx = tempfile.TemporaryDirectory(dir=TMP_ROOT)
+        cls.tmpdir = cls._tmp_ctx.name
 
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     @staticmethod
     def get_random_key(key_size=256):
         """Generate a random key of the specified length."""
-        return os.urandom(int(key_size/8))
+        assert key_size % 8 == 0, 'key_size must be a whole number of bytes.'
+        return secrets.token_bytes(key_size >> 3)
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 class TestEngine(EngineTestBaseClass):
@@ -70,18 +118,26 @@ class TestEngine(EngineTestBaseClass):
     def test_engine_encrypt(self):
         '''Test the _engine.encrypt method.'''
 
+        for size in PAYLOAD_SIZES:
+            with self.subTest(size=size):
+                self.clean_tmpdir()
+                self._check_engine_encrypt(size)
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _check_engine_encrypt(self, size):
+        '''Round trip a size byte payload through _engine.'''
+
         key = self.get_random_key()
 
         plaintext_path = os.path.join(self.tmpdir, 'plaintext')
         orig_plaintext_path = plaintext_path + '.orig'
 
-        with open(plaintext_path, 'w') as fptr:
-            fptr.write('Slithy toves\n')
+        write_payload(plaintext_path, size)
 
         # Create a backup so we can remove the original to ensure it's
         # recreated when we unencrypt with default naming.
         shutil.copy(plaintext_path, orig_plaintext_path)
-        self.assertTrue(filecmp.cmp(plaintext_path, orig_plaintext_path))
+        self.assertEqual(digest(plaintext_path), digest(orig_plaintext_path))
 
         ciphertext_path = os.path.join(self.tmpdir, 'ciphertext')
         recovered_path = os.path.join(self.tmpdir, 'recoveredtext')
@@ -89,7 +145,7 @@ class TestEngine(EngineTestBaseClass):
         # - - - - - - - - - - - - - - - -
         _engine.encrypt_file(key, plaintext_path, ciphertext_path)
         _engine.decrypt_file(key, ciphertext_path, recovered_path)
-        self.assertTrue(filecmp.cmp(orig_plaintext_path, recovered_path))
+        self.assertEqual(digest(orig_plaintext_path), digest(recovered_path))
 
         # - - - - - - - - - - - - - - - -
         _engine.encrypt_file(key, plaintext_path)
@@ -112,7 +168,319 @@ class TestEngine(EngineTestBaseClass):
             os.path.basename(plaintext_path) in
             os.listdir(self.tmpdir)
             )
-        self.assertTrue(filecmp.cmp(plaintext_path, orig_plaintext_path))
+        self.assertEqual(digest(plaintext_path), digest(orig_plaintext_path))
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def test_engine_encrypt_without_preallocate(self):
+        '''Test _engine.encrypt where the output cannot be preallocated.
+
+        The input is still mapped, but the ciphertext is written by the
+        _transform_stream writer thread instead of into a mapped output.
+        '''
+
+        with mock.patch.object(_engine, '_preallocate', return_value=False):
+            self._check_engine_encrypt(PAYLOAD_SIZES[-1])
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def test_engine_encrypt_failure(self):
+        '''Test _engine.encrypt removes its output when encryption fails.'''
+
+        key = self.get_random_key()
+
+        plaintext_path = os.path.join(self.tmpdir, 'plaintext')
+        ciphertext_path = os.path.join(self.tmpdir, 'ciphertext')
+
+        new_cipher_context = _engine._new_cipher_context
+
+        def failing_cipher_context(*args, **kwargs):
+            '''Return a cipher context failing on its second chunk.'''
+            context = new_cipher_context(*args, **kwargs)
+            calls = []
+
+            def update_into(data, buf):
+                calls.append(len(data))
+                if len(calls) == 2:
+                    raise RuntimeError('Simulated encryption failure.')
+                return context.update_into(data, buf)
+
+            return mock.Mock(wraps=context, update_into=update_into)
+
+        # Stream, mapped input, and mapped input and output.
+        for size, preallocate in [
+                (1 << 20, True),
+                (PAYLOAD_SIZES[-1], False),
+                (PAYLOAD_SIZES[-1], True)
+                ]:
+            with self.subTest(size=size, preallocate=preallocate):
+                write_payload(plaintext_path, size, zeros=True)
+
+                with contextlib.ExitStack() as stack:
+                    stack.enter_context(mock.patch.object(
+                        _engine, '_new_cipher_context', failing_cipher_context
+                        ))
+                    if not preallocate:
+                        stack.enter_context(mock.patch.object(
+                            _engine, '_preallocate', return_value=False
+                            ))
+                    encrypt_mapped = stack.enter_context(mock.patch.object(
+                        _engine, '_encrypt_mapped',
+                        wraps=_engine._encrypt_mapped
+                        ))
+
+                    with self.assertRaises(RuntimeError):
+                        _engine.encrypt_file(
+                            key, plaintext_path, ciphertext_path,
+                            chunksize=4096
+                            )
+                    self.assertEqual(
+                        encrypt_mapped.called,
+                        preallocate and size > _engine._MMAP_THRESHOLD
+                        )
+                self.assertFalse(os.path.exists(ciphertext_path))
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def test_engine_decrypt_tampered(self):
+        '''Test _engine.decrypt rejects modified ciphertext.'''
+
+        key = self.get_random_key()
+
+        plaintext_path = os.path.join(self.tmpdir, 'plaintext')
+        ciphertext_path = os.path.join(self.tmpdir, 'ciphertext')
+        recovered_path = os.path.join(self.tmpdir, 'recoveredtext')
+
+        write_payload(plaintext_path, 4096, zeros=True)
+
+        _engine.encrypt_file(key, plaintext_path, ciphertext_path)
+
+        # Flip a bit in the last ciphertext byte, just before the tag.
+        with open(ciphertext_path, 'r+b') as fptr:
+            fptr.seek(-17, os.SEEK_END)
+            byte = fptr.read(1)
+            fptr.seek(-17, os.SEEK_END)
+            fptr.write(bytes([byte[0] ^ 0x01]))
+
+        with self.assertRaises(errors.DecryptionError):
+            _engine.decrypt_file(key, ciphertext_path, recovered_path)
+        self.assertFalse(os.path.exists(recovered_path))
+
+        # - - - - - - - - - - - - - - - -
+        with self.assertRaises(errors.DecryptionError):
+            _engine.decrypt_file(
+                self.get_random_key(), ciphertext_path, recovered_path
+                )
+        self.assertFalse(os.path.exists(recovered_path))
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def test_engine_decrypt_truncated(self):
+        '''Test _engine.decrypt rejects empty and truncated files.'''
+
+        key = self.get_random_key()
+
+        plaintext_path = os.path.join(self.tmpdir, 'plaintext')
+        ciphertext_path = os.path.join(self.tmpdir, 'ciphertext')
+        truncated_path = os.path.join(self.tmpdir, 'truncated')
+        recovered_path = os.path.join(self.tmpdir, 'recoveredtext')
+
+        write_payload(plaintext_path, 4096, zeros=True)
+
+        _engine.encrypt_file(key, plaintext_path, ciphertext_path)
+        with open(ciphertext_path, 'rb') as fptr:
+            ciphertext = fptr.read()
+
+        # Cut in the marker, the length field, the nonce, the ciphertext
+        # and the tag.
+        for length in [0, 4, 12, 20, 1000, len(ciphertext) - 1]:
+            with self.subTest(length=length):
+                with open(truncated_path, 'wb') as fptr:
+                    fptr.write(ciphertext[:length])
+
+                with self.assertRaises(errors.DecryptionError):
+                    _engine.decrypt_file(key, truncated_path, recovered_path)
+                self.assertFalse(os.path.exists(recovered_path))
+
+        # - - - - - - - - - - - - - - - -
+        write_legacy_ciphertext(key, bytes(4096), ciphertext_path)
+        with open(ciphertext_path, 'rb') as fptr:
+            ciphertext = fptr.read()
+
+        for length in [4, 12, 1000, len(ciphertext) - 16]:
+            with self.subTest(legacy_length=length):
+                with open(truncated_path, 'wb') as fptr:
+                    fptr.write(ciphertext[:length])
+
+                with self.assertRaises(errors.DecryptionError):
+                    _engine.decrypt_file(key, truncated_path, recovered_path)
+                self.assertFalse(os.path.exists(recovered_path))
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def test_engine_decrypt_legacy(self):
+        '''Test _engine.decrypt reads files from cryptkeeper 1.x.'''
+
+        key = self.get_random_key()
+
+        ciphertext_path = os.path.join(self.tmpdir, 'ciphertext')
+        recovered_path = os.path.join(self.tmpdir, 'recoveredtext')
+
+        for size in [0, 13, 4096]:
+            with self.subTest(size=size):
+                plaintext = os.urandom(size)
+                write_legacy_ciphertext(key, plaintext, ciphertext_path)
+
+                _engine.decrypt_file(key, ciphertext_path, recovered_path)
+                with open(recovered_path, 'rb') as fptr:
+                    self.assertEqual(fptr.read(), plaintext)
+                os.remove(recovered_path)
+
+                with self.assertRaises(errors.DecryptionError):
+                    _engine.decrypt_file(
+                        self.get_random_key(), ciphertext_path,
+                        recovered_path
+                        )
+                self.assertFalse(os.path.exists(recovered_path))
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def test_engine_decrypt_unsupported_version(self):
+        '''Test _engine.decrypt rejects unknown format versions.'''
+
+        key = self.get_random_key()
+
+        plaintext_path = os.path.join(self.tmpdir, 'plaintext')
+        ciphertext_path = os.path.join(self.tmpdir, 'ciphertext')
+        recovered_path = os.path.join(self.tmpdir, 'recoveredtext')
+
+        write_payload(plaintext_path, 4096, zeros=True)
+
+        _engine.encrypt_file(key, plaintext_path, ciphertext_path)
+
+        # The format version follows the 7 byte marker.
+        with open(ciphertext_path, 'r+b') as fptr:
+            fptr.seek(7)
+            fptr.write(bytes([_engine._FORMAT_VERSION + 1]))
+
+        with self.assertRaises(errors.UnsupportedFormatError):
+            _engine.decrypt_file(key, ciphertext_path, recovered_path)
+        self.assertFalse(os.path.exists(recovered_path))
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def test_engine_encrypting_writer(self):
+        '''Test _engine.EncryptingWriter output with decrypt_stream.'''
+
+        key = self.get_random_key()
+        plaintext = os.urandom(100000)
+
+        # Start after some other data, as in an envelope.
+        ciphertext_fptr = io.BytesIO()
+        ciphertext_fptr.write(b'prefix')
+
+        with _engine.EncryptingWriter(key, ciphertext_fptr) as writer:
+            for start in range(0, len(plaintext), 4099):
+                writer.write(plaintext[start:start + 4099])
+
+        self.assertEqual(
+            len(ciphertext_fptr.getvalue()),
+            len(b'prefix') + _engine._HEADER_SIZE + len(plaintext) +
+            _engine._TAG_SIZE
+            )
+
+        ciphertext_fptr.seek(len(b'prefix'))
+        recovered_fptr = io.BytesIO()
+        _engine.decrypt_stream(
+            key, ciphertext_fptr, recovered_fptr, chunksize=4096
+            )
+        self.assertEqual(recovered_fptr.getvalue(), plaintext)
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def test_engine_encrypting_writer_tampered(self):
+        '''Test _engine.decrypt_stream rejects modified writer output.'''
+
+        key = self.get_random_key()
+
+        ciphertext_fptr = io.BytesIO()
+        with _engine.EncryptingWriter(key, ciphertext_fptr) as writer:
+            writer.write(bytes(4096))
+        ciphertext = ciphertext_fptr.getvalue()
+
+        # Flip a bit in the length field, the nonce, the ciphertext and
+        # the tag.
+        length_offset = _engine._LENGTH_OFFSET
+        for offset in [
+                length_offset, length_offset + 8, _engine._HEADER_SIZE + 100,
+                len(ciphertext) - 1
+                ]:
+            with self.subTest(offset=offset):
+                tampered = bytearray(ciphertext)
+                tampered[offset] ^= 0x01
+
+                with self.assertRaises(errors.DecryptionError):
+                    _engine.decrypt_stream(
+                        key, io.BytesIO(tampered), io.BytesIO()
+                        )
+
+        # - - - - - - - - - - - - - - - -
+        with self.assertRaises(errors.DecryptionError):
+            _engine.decrypt_stream(
+                self.get_random_key(), io.BytesIO(ciphertext), io.BytesIO()
+                )
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def test_engine_chunksize(self):
+        '''Test _engine chunksize validation.'''
+
+        key = self.get_random_key()
+
+        plaintext_path = os.path.join(self.tmpdir, 'plaintext')
+        ciphertext_path = os.path.join(self.tmpdir, 'ciphertext')
+
+        write_payload(plaintext_path, 4096, zeros=True)
+
+        for chunksize in [0, 1000, 4096 + 16]:
+            with self.assertRaises(ValueError):
+                _engine.encrypt_file(
+                    key, plaintext_path, ciphertext_path, chunksize=chunksize
+                    )
+            self.assertFalse(os.path.exists(ciphertext_path))
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+@unittest.skipIf(_engine.AES is None, 'pycryptodome not installed')
+class TestEnginePycryptodome(TestEngine):
+    '''The TestEngine cases, with the pycryptodome fallback backend.'''
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def setUp(self):
+        '''Switch _engine to pycryptodome for the test.'''
+        super().setUp()
+
+        patcher = mock.patch.object(_engine, '_BACKEND', 'pycryptodome')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    @unittest.skipIf(_engine.Cipher is None, 'cryptography not installed')
+    def test_engine_backends_interoperate(self):
+        '''Test each backend decrypts what the other encrypted.'''
+
+        key = self.get_random_key()
+
+        plaintext_path = os.path.join(self.tmpdir, 'plaintext')
+        ciphertext_path = os.path.join(self.tmpdir, 'ciphertext')
+        recovered_path = os.path.join(self.tmpdir, 'recoveredtext')
+
+        write_payload(plaintext_path, 100000)
+
+        for encrypt_backend, decrypt_backend in [
+                ('pycryptodome', 'cryptography'),
+                ('cryptography', 'pycryptodome')
+                ]:
+            with self.subTest(encrypt=encrypt_backend):
+                with mock.patch.object(_engine, '_BACKEND', encrypt_backend):
+                    _engine.encrypt_file(key, plaintext_path, ciphertext_path)
+                with mock.patch.object(_engine, '_BACKEND', decrypt_backend):
+                    _engine.decrypt_file(key, ciphertext_path, recovered_path)
+
+                self.assertEqual(
+                    digest(plaintext_path), digest(recovered_path)
+                    )
 
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
@@ -125,6 +493,9 @@ all_suites = {
     'suite_TestEngine': load_case(
         TestEngine
         ),
+    'suite_TestEnginePycryptodome': load_case(
+        TestEnginePycryptodome
+        ),
     }
 
 master_suite = unittest.TestSuite(all_suites.values())
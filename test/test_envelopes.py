@@ -1,18 +1,25 @@
 """Test cases for the envelope.py module."""
 
-import filecmp
 import logging
 import os
+import secrets
 import shutil
 import tempfile
 import warnings
 
 import unittest
 
+import boto3
+import botocore.exceptions
+
 # from cryptkeeper import _engine
 from cryptkeeper import errors
 from cryptkeeper import envelope
 
+from _helpers import digest
+from _helpers import TMP_ROOT
+from _helpers import write_payload
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 # Uncomment to show lower level logging statements.
 # import logging
@@ -36,23 +43,79 @@ TESTING_KMS_MASTER_KEY_ARN = (
     'cf04fbf4-8119-4441-953b-1e5115e859dd'
     )
 
-# Suppress stdout messages in python 3.
+# Plaintext sizes the envelope round trip tests are run with.
+PAYLOAD_SIZES = (4096, 1 << 20)
+
+# Suppress stdout messages in python 3. NullHandler discards records without
+# formatting them, and botocore's per-request logging is dropped before it
+# gets that far.
 root_logger = logging.getLogger()
-fhandler = logging.FileHandler('/dev/null/')
-root_logger.addHandler(fhandler)
+root_logger.addHandler(logging.NullHandler())
+logging.getLogger('botocore').setLevel(logging.WARNING)
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+class StubKmsClient(object):
+    """Stand-in for a boto3 KMS client, for tests that need no AWS.
+
+    Its ciphertext blobs are the data key behind a fixed prefix. The names
+    of the methods called are recorded in calls.
+    """
+
+    KEY_ARN = 'arn:aws:kms:us-west-1:000000000000:key/stub'
+    BLOB_PREFIX = b'stub:'
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def __init__(self):
+        self.calls = []
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _response(self, method, **response):
+        self.calls.append(method)
+        response['ResponseMetadata'] = {
+            'HTTPStatusCode': envelope.HTTP_OK, 'RequestId': 'stub'
+            }
+        return response
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def generate_data_key(self, KeyId, KeySpec):
+        # pylint: disable=invalid-name,unused-argument
+        data_key = secrets.token_bytes(32)
+        return self._response(
+            'generate_data_key', KeyId=self.KEY_ARN, Plaintext=data_key,
+            CiphertextBlob=self.BLOB_PREFIX + data_key
+            )
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def encrypt(self, KeyId, Plaintext):
+        # pylint: disable=invalid-name,unused-argument
+        return self._response(
+            'encrypt', KeyId=self.KEY_ARN,
+            CiphertextBlob=self.BLOB_PREFIX + Plaintext
+            )
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def decrypt(self, CiphertextBlob):
+        # pylint: disable=invalid-name
+        return self._response(
+            'decrypt', KeyId=self.KEY_ARN,
+            Plaintext=bytes(CiphertextBlob[len(self.BLOB_PREFIX):])
+            )
 
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 class EnvelopesTestBaseClass(unittest.TestCase):
     """Common base class for Envelopes testing."""
 
+    _tmp_ctx = None
     tmpdir = None
 
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     @classmethod
     def setUpClass(cls):
         """Test case class common fixture setup."""
-        cls.tmpdir = tempfile.mkdtemp()
+        cls._tmp_ctx = tempfile.TemporaryDirectory(dir=TMP_ROOT)
+        cls.tmpdir = cls._tmp_ctx.name
 
         # Filter warnings.
         # See https://github.com/boto/boto3/issues/454.
@@ -65,9 +128,9 @@ class EnvelopesTestBaseClass(unittest.TestCase):
     @classmethod
     def tearDownClass(cls):
         """Test case class common fixture teardown."""
-        cls.clean_tmpdir()
-        os.rmdir(cls.tmpdir)
+        cls._tmp_ctx.cleanup()
 
+        cls._tmp_ctx = None
         cls.tmpdir = None  # Yeah, it's superfluous.
 
         # Unfilter warnings.
@@ -80,25 +143,75 @@ class EnvelopesTestBaseClass(unittest.TestCase):
 
         self.clean_tmpdir()
 
-        self.assertIn('AWS_PROFILE', list(os.environ.keys()))
-        self.assertIn('AWS_DEFAULT_REGION', os.environ)
-
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     @classmethod
     def clean_tmpdir(cls):
-        """Remove all content from cls.tmpdir."""
-        if cls.tmpdir:
-            for root, dirs, files in os.walk(cls.tmpdir, topdown=False):
-                for name in files:
-                    os.remove(os.path.join(root, name))
-                for name in dirs:
-                    os.rmdir(os.path.join(root, name))
+        """Replace cls.tmpdir with a new, empty directory."""
+        if cls._tmp_ctx:
+            cls._tmp_ctx.cleanup()
+            cls._tmp_ctx = tempfile.TemporaryDirectory(dir=TMP_ROOT)
+            cls.tmpdir = cls._tmp_ctx.name
 
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     @staticmethod
     def get_random_key(key_size=256):
         """Generate a random key of the specified length."""
-        return os.urandom(int(key_size/8))
+        assert key_size % 8 == 0, 'key_size must be a whole number of bytes.'
+        return secrets.token_bytes(key_size >> 3)
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+class KmsTestMixin(object):
+    """Mixin for test cases that call AWS KMS.
+
+    The test case class is skipped unless an AWS profile and region are
+    configured. Otherwise one KMS client and one real KmsAgent are created
+    for the class, so every agent reuses the same credentials and HTTPS
+    connection pool, and each test method does not need its own
+    GenerateDataKey round trip.
+    """
+
+    _kms = None
+    _shared_agent = None
+    _shared_data_key = None
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    @classmethod
+    def setUpClass(cls):
+        """Skip without AWS, else create the shared KmsAgent."""
+        if (
+                'AWS_PROFILE' not in os.environ
+                or 'AWS_DEFAULT_REGION' not in os.environ
+                ):
+            raise unittest.SkipTest('AWS not configured')
+
+        # Created here rather than on import, so a bad profile only skips
+        # the test cases that need AWS.
+        try:
+            kms = boto3.session.Session().client('kms')
+        except (
+                botocore.exceptions.ProfileNotFound,
+                botocore.exceptions.NoRegionError
+                ) as exc:
+            raise unittest.SkipTest('AWS not configured: {}'.format(exc))
+
+        super().setUpClass()
+
+        cls._kms = kms
+        cls._shared_agent = envelope.KmsAgent(
+            master_key_id=TESTING_KMS_MASTER_KEY_ARN, kms_client=cls._kms
+            )
+        cls._shared_data_key = cls._shared_agent.data_key
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    @classmethod
+    def tearDownClass(cls):
+        """Drop the shared KmsAgent and KMS client."""
+        cls._shared_agent = None
+        cls._shared_data_key = None
+        cls._kms = None
+
+        super().tearDownClass()
 
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
@@ -136,9 +249,82 @@ class TestKmsAgentModule(EnvelopesTestBaseClass):
         self.assertEqual(envelope.envelope_name(envelope_archive_name), envelope_name)
         self.assertEqual(envelope.envelope_archive_name(envelope_archive_name), envelope_archive_name)
 
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def test_kms_agent_filename_errors(self):
+        """Test KmsAgent module filename methods reject empty names. """
+
+        for method in [
+                envelope.plain_name,
+                envelope.archive_name,
+                envelope.envelope_name,
+                envelope.envelope_archive_name
+                ]:
+            with self.assertRaises(ValueError):
+                method('')
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def test_kms_agent_ciphertext_blob_cache(self):
+        """Test KmsAgent decrypts a repeated ciphertext blob only once. """
+
+        envelope._decrypt_ciphertext_blob.cache_clear()
+        self.addCleanup(envelope._decrypt_ciphertext_blob.cache_clear)
+
+        kms_client = StubKmsClient()
+        data_key = self.get_random_key()
+        blob = StubKmsClient.BLOB_PREFIX + data_key
+
+        # A bytearray blob, as read into a buffer, must hit the same entry.
+        for ciphertext_blob in [blob, bytearray(blob), blob]:
+            agent = envelope.KmsAgent(
+                ciphertext_blob=ciphertext_blob, kms_client=kms_client
+                )
+            self.assertEqual(agent.master_key_id, StubKmsClient.KEY_ARN)
+            self.assertEqual(agent.data_key, data_key)
+
+        self.assertEqual(kms_client.calls, ['decrypt'])
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+class TestEnveloperModule(EnvelopesTestBaseClass):
+    """Test cases for Enveloper functionality that needs no AWS. """
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def test_enveloper_envelopes_duplicates(self):
+        """Test Enveloper rejects sources sharing an envelope path. """
+
+        plaintext_paths = [
+            os.path.join(self.tmpdir, subdir, 'plaintext')
+            for subdir in ['a', 'b']
+            ]
+
+        for plaintext_path in plaintext_paths:
+            os.mkdir(os.path.dirname(plaintext_path))
+            write_payload(plaintext_path, 4096, zeros=True)
+
+        kms_client = StubKmsClient()
+        enveloper = envelope.Enveloper(
+            kms_agent=envelope.KmsAgent(
+                master_key_id=StubKmsClient.KEY_ARN, kms_client=kms_client
+                )
+            )
+
+        # - - - - - - - - - - - - - - - -
+        with self.assertRaises(ValueError):
+            enveloper.create_envelopes(plaintext_paths, self.tmpdir)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.tmpdir, 'plaintext.kms-envelope.tgz')
+            ))
+
+        # Without an output_path, each envelope goes beside its source.
+        envelope_paths = enveloper.create_envelopes(plaintext_paths)
+        self.assertEqual(
+            envelope_paths,
+            [path + '.kms-envelope.tgz' for path in plaintext_paths]
+            )
+
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-class TestKmsAgent(EnvelopesTestBaseClass):
+class TestKmsAgent(KmsTestMixin, EnvelopesTestBaseClass):
     """Test cases for KmsAgent class functionality. """
 
     # TODO: Check for environment variables with AWS profile, credentials, etc.
@@ -158,7 +344,7 @@ class TestKmsAgent(EnvelopesTestBaseClass):
 
         # - - - - - - - - - - - - - - - -
         mki_agent = envelope.KmsAgent(
-            master_key_id=TESTING_KMS_MASTER_KEY_ID
+            master_key_id=TESTING_KMS_MASTER_KEY_ID, kms_client=self._kms
             )
 
         self.assertIsNotNone(mki_agent.master_key_alias)
@@ -170,9 +356,7 @@ class TestKmsAgent(EnvelopesTestBaseClass):
         self.assertIsNotNone(mki_agent.ciphertext_blob)
 
         # - - - - - - - - - - - - - - - -
-        mki_agent = envelope.KmsAgent(
-            master_key_id=TESTING_KMS_MASTER_KEY_ARN
-            )
+        mki_agent = self._shared_agent
 
         self.assertIsNone(mki_agent.master_key_alias)
         self.assertEqual(mki_agent.master_key_id, TESTING_KMS_MASTER_KEY_ARN)
@@ -182,11 +366,12 @@ class TestKmsAgent(EnvelopesTestBaseClass):
         self.assertIsNotNone(mki_agent.ciphertext_blob)
 
         # - - - - - - - - - - - - - - - -
-        data_key = mki_agent.data_key
+        data_key = self._shared_data_key
 
         dk_agent = envelope.KmsAgent(
             master_key_id=TESTING_KMS_MASTER_KEY_ARN,
-            data_key=data_key
+            data_key=data_key,
+            kms_client=self._kms
             )
 
         self.assertIsNone(mki_agent.master_key_alias)
@@ -200,7 +385,7 @@ class TestKmsAgent(EnvelopesTestBaseClass):
         blob = dk_agent.ciphertext_blob
 
         cb_agent = envelope.KmsAgent(
-            ciphertext_blob=blob
+            ciphertext_blob=blob, kms_client=self._kms
             )
 
         self.assertIsNone(mki_agent.master_key_alias)
@@ -217,21 +402,27 @@ class TestKmsAgent(EnvelopesTestBaseClass):
     def test_kms_agent_envelope(self):
         """Test KmsAgent envelope creation. """
 
+        for size in PAYLOAD_SIZES:
+            with self.subTest(size=size):
+                self.clean_tmpdir()
+                self._check_kms_agent_envelope(size)
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _check_kms_agent_envelope(self, size):
+        """Round trip a size byte payload through an envelope. """
+
         plaintext_path = os.path.join(self.tmpdir, 'plaintext')
         orig_plaintext_path = plaintext_path + '.orig'
 
-        with open(plaintext_path, 'w') as fptr:
-            fptr.write('Slithy toves\n')
+        write_payload(plaintext_path, size)
 
         # Create a backup so we can remove the original to ensure it's
         # recreated when we unencrypt with default naming.
         shutil.copy(plaintext_path, orig_plaintext_path)
-        self.assertTrue(filecmp.cmp(plaintext_path, orig_plaintext_path))
+        self.assertEqual(digest(plaintext_path), digest(orig_plaintext_path))
 
         # - - - - - - - - - - - - - - - -
-        agent = envelope.KmsAgent(
-            master_key_id=TESTING_KMS_MASTER_KEY_ARN
-            )
+        agent = self._shared_agent
 
         expected_envelope_archive_path = os.path.join(
             self.tmpdir, plaintext_path + '.kms-envelope.tgz'
@@ -245,11 +436,91 @@ class TestKmsAgent(EnvelopesTestBaseClass):
         os.remove(plaintext_path)
         self.assertFalse(os.path.exists(plaintext_path))
 
-        unpacked_path = agent.open_envelope(envelope_path, self.tmpdir)
+        unpacked_path = agent.open_envelope(
+            envelope_path, self.tmpdir, kms_client=self._kms
+            )
 
         self.assertEqual(unpacked_path, plaintext_path)
         self.assertTrue(os.path.exists(plaintext_path))
-        self.assertTrue(filecmp.cmp(plaintext_path, orig_plaintext_path))
+        self.assertEqual(digest(plaintext_path), digest(orig_plaintext_path))
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+class TestEnveloper(KmsTestMixin, EnvelopesTestBaseClass):
+    """Test cases for Enveloper class functionality. """
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def test_enveloper_errors(self):
+        """Test Enveloper errors. """
+
+        plaintext_path = os.path.join(self.tmpdir, 'plaintext')
+
+        write_payload(plaintext_path, 4096, zeros=True)
+
+        # - - - - - - - - - - - - - - - -
+        with self.assertRaises(errors.KmsHelperInitializationError):
+            envelope.Enveloper().create_envelope(plaintext_path, self.tmpdir)
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def test_enveloper_envelope(self):
+        """Test Enveloper envelope creation. """
+
+        plaintext_path = os.path.join(self.tmpdir, 'plaintext')
+        orig_plaintext_path = plaintext_path + '.orig'
+
+        write_payload(plaintext_path, 4096, zeros=True)
+
+        shutil.copy(plaintext_path, orig_plaintext_path)
+
+        # - - - - - - - - - - - - - - - -
+        enveloper = envelope.Enveloper(kms_agent=self._shared_agent)
+
+        envelope_path = enveloper.create_envelope(plaintext_path, self.tmpdir)
+        self.assertTrue(os.path.exists(envelope_path))
+
+        os.remove(plaintext_path)
+        self.assertFalse(os.path.exists(plaintext_path))
+
+        unpacked_path = envelope.Enveloper.open_envelope(
+            envelope_path, self.tmpdir, kms_client=self._kms
+            )
+
+        self.assertEqual(unpacked_path, plaintext_path)
+        self.assertEqual(digest(plaintext_path), digest(orig_plaintext_path))
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def test_enveloper_envelopes(self):
+        """Test Enveloper parallel envelope creation. """
+
+        plaintext_paths = [
+            os.path.join(self.tmpdir, 'plaintext{}'.format(i))
+            for i in range(4)
+            ]
+
+        for plaintext_path in plaintext_paths:
+            write_payload(plaintext_path, 4096)
+            shutil.copy(plaintext_path, plaintext_path + '.orig')
+
+        # - - - - - - - - - - - - - - - -
+        enveloper = envelope.Enveloper(kms_agent=self._shared_agent)
+
+        envelope_paths = enveloper.create_envelopes(
+            plaintext_paths, self.tmpdir
+            )
+        self.assertEqual(len(envelope_paths), len(plaintext_paths))
+
+        for plaintext_path, envelope_path in zip(
+                plaintext_paths, envelope_paths
+                ):
+            os.remove(plaintext_path)
+            unpacked_path = envelope.Enveloper.open_envelope(
+                envelope_path, self.tmpdir, kms_client=self._kms
+                )
+
+            self.assertEqual(unpacked_path, plaintext_path)
+            self.assertEqual(
+                digest(plaintext_path), digest(plaintext_path + '.orig')
+                )
 
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
@@ -259,9 +530,18 @@ class TestKmsAgent(EnvelopesTestBaseClass):
 load_case = unittest.TestLoader().loadTestsFromTestCase
 all_suites = {
     # Lowercase these.
+    'suite_TestKmsAgentModule': load_case(
+        TestKmsAgentModule
+        ),
+    'suite_TestEnveloperModule': load_case(
+        TestEnveloperModule
+        ),
     'suite_TestKmsAgent': load_case(
         TestKmsAgent
         ),
+    'suite_TestEnveloper': load_case(
+        TestEnveloper
+        ),
     }
 
 master_suite = unittest.TestSuite(all_suites.values())